@@ -7,11 +7,23 @@ Created on Tue Jul  8 09:49:25 2025
 
 import requests
 import json
+import copy
+import os
+import re
+import sys
+import time
+import gzip
+import zlib
+import hashlib
+import inspect
+import webbrowser
 from pyjstat import pyjstat
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.stats import mannwhitneyu
+import plotly
 import plotly.express as px
 
 """
@@ -23,17 +35,194 @@ https://github.com/varmais/maakunnat/blob/master/maakunnat.geojson
 
 Before running this code, make sure you have already installed all the required libraries. 
 Some visualizations will open in a browser window and will be saved to your hard drive as HTML files VIA Plotly. 
-If you don't want to save anything to your hard drive, please remove lines 103, 113, 139 & 605 from Main.py
+If you don't want to save anything to your hard drive, please remove the fig.write_html call and the
+kaaviot.json update from the tallenna-function in Main.py (it saves the HTML files and their fingerprints).
+Unchanged charts are not redrawn: if the data and parameters match kaaviot.json, the saved HTML file is opened instead.
+Queries made with datahaku(..., muoto="auto") also save their download measurements to muotomittaukset.json
+(used by the datahaku_paloittain call for the municipality data; remove muoto="auto" there to avoid this).
 """
 
+# Eri vastausmuotojen mitatut tavumäärät sekä lataus- ja purkuajat tallennetaan tähän tiedostoon taulukoittain
+MUOTOMITTAUKSET = "muotomittaukset.json"
+
+# Aika sekunteina, jonka jälkeen epäonnistuneen purun jälkeen ohitettua vastausmuotoa kokeillaan uudelleen (vuorokausi)
+VIRHEEN_VOIMASSAOLO = 24 * 60 * 60
+
+# Funktio purkaa json-stat2-vastauksen DataFrameksi pyjstat-kirjastolla
+def pura_jsonstat2(sisalto, naming):
+    dataset = pyjstat.Dataset.read(sisalto.decode("utf-8"))
+    return dataset.write("dataframe", naming=naming)
+
+# Funktio jakaa PX-tiedoston otsakkeen lauseisiin puolipisteiden kohdalta ja tietyn lauseen arvon pilkkujen kohdalta.
+# Lainausmerkkien sisällä olevia merkkejä ei käsitellä erottimina.
+def px_jaa(teksti, erotin):
+    osat = []
+    alku = 0
+    lainauksessa = False
+    for i, merkki in enumerate(teksti):
+        if merkki == '"':
+            lainauksessa = not lainauksessa
+        elif merkki == erotin and not lainauksessa:
+            osat.append(teksti[alku:i])
+            alku = i + 1
+    osat.append(teksti[alku:])
+    return osat
+
+# Funktio purkaa PX-muotoisen vastauksen samaan pitkään muotoon kuin pyjstat (muuttujat sarakkeina ja "value").
+# PX-tiedosto sisältää muuttujien arvot (VALUES) ja koodit (CODES) sekä datan yhtenä lukujonona, jossa
+# STUB- ja HEADING-muuttujat vaihtelevat samassa järjestyksessä kuin tuloksen rivit.
+def pura_px(sisalto, naming):
+    koodisivu = re.search(rb'CODEPAGE="([^"]+)"', sisalto[:2000])
+    if koodisivu:
+        koodisivu = koodisivu.group(1).decode("ascii")
+    elif b'CHARSET="ANSI"' in sisalto[:2000]:
+        koodisivu = "cp1252"
+    else:
+        koodisivu = "utf-8"
+    teksti = sisalto.decode("utf-8-sig" if koodisivu.lower() in ("utf-8", "utf8") else koodisivu)
+
+    otsake, data = teksti.split("DATA=", 1)
+    tiedot = {}
+    for lause in px_jaa(otsake, ";"):
+        osat = re.match(r'\s*([A-Z0-9-]+)(\[[^\]]*\])?(?:\("([^"]*)"\))?\s*=(.*)', lause, re.DOTALL)
+        # Ohitetaan muunkieliset käännökset (esim. VALUES[sv])
+        if osat is None or osat.group(2):
+            continue
+        arvot = ["".join(re.findall(r'"([^"]*)"', arvo)) for arvo in px_jaa(osat.group(4), ",")]
+        tiedot[(osat.group(1), osat.group(3))] = arvot
+
+    muuttujat = tiedot.get(("STUB", None), []) + tiedot.get(("HEADING", None), [])
+    puuttuvat = [m for m in muuttujat if ("VALUES", m) not in tiedot]
+    if not muuttujat or puuttuvat:
+        raise ValueError(f"PX-tiedostosta puuttuvat muuttujat tai niiden arvot: {', '.join(puuttuvat)}")
+    if naming == "id":
+        nimet = [tiedot.get(("VARIABLECODE", m), [m])[0] for m in muuttujat]
+        arvot = [tiedot.get(("CODES", m), tiedot[("VALUES", m)]) for m in muuttujat]
+    else:
+        nimet = muuttujat
+        arvot = [tiedot[("VALUES", m)] for m in muuttujat]
+
+    df = pd.MultiIndex.from_product(arvot, names=nimet).to_frame(index=False)
+    luvut = data.split(";", 1)[0].replace('"', " ").split()
+    if len(luvut) != len(df):
+        raise ValueError(f"PX-tiedoston DATA-osassa on {len(luvut)} arvoa, odotettiin {len(df)}")
+    df["value"] = pd.to_numeric(pd.Series(luvut), errors="coerce")
+
+    return df
+
+# Tuetut vastausmuodot ja niiden purkufunktiot. PxWebin csv-muoto on leveä ristiintaulukko, jonka sarakkeiden
+# muoto riippuu taulukosta, joten sitä ei voi purkaa samaan muotoon ilman erillistä metatietokyselyä.
+PURKAJAT = {
+    "json-stat2": pura_jsonstat2,
+    "px": pura_px
+    }
+
+# Funktiot lukevat ja kirjoittavat muotomittaukset (taulukon osoite -> vastausmuoto -> mittaus)
+def lue_mittaukset():
+    if not os.path.exists(MUOTOMITTAUKSET):
+        return {}
+    with open(MUOTOMITTAUKSET, encoding="utf-8") as f:
+        return json.load(f)
+
+def kirjoita_mittaukset(kaikki):
+    with open(MUOTOMITTAUKSET, "w", encoding="utf-8") as f:
+        json.dump(kaikki, f, ensure_ascii=False, indent=2)
+
+# Funktio valitsee taulukolle halvimman vastausmuodon aiempien mittausten perusteella. Mittaukset ovat
+# solua kohden laskettuja keskiarvoja, joten eri kokoiset haut (esim. paloittaisen haun viimeinen pala) ovat vertailukelpoisia.
+# Kustannus solua kohden = siirretyt tavut / siirtonopeus + purkuaika, missä siirtonopeus (tavua/s) arvioidaan
+# taulukon kaikista mittauksista. Mittaamattomat muodot kokeillaan ensin yksi kerrallaan, jolloin jokainen haku
+# on silti vain yksi kysely. Muotoja, joiden purku on epäonnistunut, ei valita ennen kuin VIRHEEN_VOIMASSAOLO on kulunut.
+def valitse_muoto(url):
+    mittaukset = lue_mittaukset().get(url, {})
+    muodot = [m for m in PURKAJAT
+              if time.time() - mittaukset.get(m, {}).get("virhe", 0) >= VIRHEEN_VOIMASSAOLO]
+
+    if not muodot:
+        return "json-stat2"
+
+    for muoto in muodot:
+        if "n" not in mittaukset.get(muoto, {}):
+            return muoto
+
+    kaista = sum(mittaukset[m]["tavut"] for m in muodot) / sum(mittaukset[m]["lataus"] for m in muodot)
+
+    return min(muodot, key=lambda m: mittaukset[m]["tavut"] / kaista + mittaukset[m]["purku"])
+
+# Funktio päivittää vastausmuodon mittauksen juoksevat keskiarvot (tavut, latausaika ja purkuaika solua kohden).
+# Onnistunut purku poistaa aiemman virhemerkinnän.
+def tallenna_mittaus(url, muoto, solut, tavut, lataus, purku):
+    kaikki = lue_mittaukset()
+    vanha = kaikki.setdefault(url, {}).get(muoto, {})
+
+    n = vanha.get("n", 0) + 1
+    uusi = {"n": n}
+    for avain, arvo in (("tavut", tavut), ("lataus", lataus), ("purku", purku)):
+        uusi[avain] = vanha.get(avain, 0) + (arvo / solut - vanha.get(avain, 0)) / n
+
+    kaikki[url][muoto] = uusi
+    kirjoita_mittaukset(kaikki)
+
+# Funktio merkitsee vastausmuodon purun epäonnistuneeksi (aikaleima), jolloin valitse_muoto ohittaa muodon
+# VIRHEEN_VOIMASSAOLON ajan. Aiemmat mittaukset säilytetään.
+def merkitse_virhe(url, muoto):
+    kaikki = lue_mittaukset()
+    kaikki.setdefault(url, {}).setdefault(muoto, {})["virhe"] = time.time()
+    kirjoita_mittaukset(kaikki)
+
+# Funktio lukee vastauksen rungon pakattuna sellaisenaan ja laskee siirretyt tavut itse. urllib3:n tell() ei laske
+# paloiteltuna (Transfer-Encoding: chunked) lähetettyjä vastauksia, joten sitä ei käytetä.
+# Pakkaus puretaan Content-Encoding-otsakkeen mukaan. Palauttaa puretun sisällön ja siirrettyjen tavujen määrän.
+def lue_vastaus(response):
+    palat = []
+    tavut = 0
+    for pala in response.raw.stream(decode_content=False):
+        palat.append(pala)
+        tavut += len(pala)
+    sisalto = b"".join(palat)
+
+    pakkaus = response.headers.get("Content-Encoding", "identity").lower()
+    try:
+        if pakkaus in ("gzip", "x-gzip"):
+            sisalto = gzip.decompress(sisalto)
+        elif pakkaus == "deflate":
+            try:
+                sisalto = zlib.decompress(sisalto)
+            except zlib.error:
+                sisalto = zlib.decompress(sisalto, -zlib.MAX_WBITS)
+        elif pakkaus != "identity":
+            raise requests.exceptions.ContentDecodingError(f"Tuntematon pakkaus: {pakkaus}")
+    except (OSError, EOFError, zlib.error) as e:
+        raise requests.exceptions.ContentDecodingError(f"Pakkauksen purku epäonnistui: {e}")
+
+    return sisalto, tavut
+
 # Funktio hakee annetusta URLsta JSON-kyselyllä (Tilastokeskuksen PxWeb)
-def datahaku(url, query):
+# muoto = vastausmuoto ("json-stat2" tai "px"), oletuksena kyselyssä annettu muoto.
+# "auto" valitsee taulukolle halvimman muodon mitattujen tavumäärien ja purkuaikojen perusteella ja tallentaa
+# mittaukset tiedostoon muotomittaukset.json. Jos vastauksen purku epäonnistuu, haetaan json-stat2-muodossa.
+# Vastaus pyydetään pakattuna (gzip, deflate), luetaan pakattuna ja puretaan lue_vastaus-funktiolla,
+# joten tavumäärä mitataan siirrettyinä eli pakattuina tavuina.
+def datahaku(url, query, naming="label", muoto=None):
     
-    headers = {"Content-Type": "application/json"}
+    automaattinen = muoto == "auto"
+    if muoto is None:
+        muoto = query["response"]["format"]
+    elif automaattinen:
+        muoto = valitse_muoto(url)
+
+    if muoto not in PURKAJAT:
+        raise ValueError(f"Vastausmuotoa {muoto} ei tueta. Tuetut muodot: {', '.join(PURKAJAT)} ja auto")
+
+    kysely = copy.deepcopy(query)
+    kysely["response"]["format"] = muoto
+
+    headers = {"Content-Type": "application/json", "Accept-Encoding": "gzip, deflate"}
     
     try:
-        print("Lähetetään kysely")
-        response = requests.post(url, headers=headers, data=json.dumps(query))
+        print(f"Lähetetään kysely ({muoto})")
+        alku = time.perf_counter()
+        response = requests.post(url, headers=headers, data=json.dumps(kysely), stream=True)
         
         print(f"Status: {response.status_code}")
         response.raise_for_status()
@@ -59,19 +248,27 @@ def datahaku(url, query):
         else:
             print("Time-out after 60 seconds. It may turn on, when extracting large XLSX datasets.")
         
-        data = response.json()
-        print("Data vastaanotettu")
+        sisalto, tavut = lue_vastaus(response)
+        lataus = time.perf_counter() - alku
+        print(f"Data vastaanotettu: {tavut} tavua ({response.headers.get('Content-Encoding', 'ei pakattu')})")
         
-        if not data:
+        if not sisalto.strip():
             print("API ei palauttanut dataa")
             return None
         
-        data = json.dumps(data)
-        
-        dataset = pyjstat.Dataset.read(data)
+        alku = time.perf_counter()
         
-        df = dataset.write("dataframe")
+        try:
+            df = PURKAJAT[muoto](sisalto, naming)
+        except (ValueError, IndexError) as e:
+            print(f"Virhe purettaessa {muoto}-muotoista vastausta:\n{e}")
+            if automaattinen and muoto != "json-stat2":
+                merkitse_virhe(url, muoto)
+                return datahaku(url, query, naming, "json-stat2")
+            return None
         
+        if automaattinen:
+            tallenna_mittaus(url, muoto, len(df), tavut, lataus, time.perf_counter() - alku)
         
         return df
     
@@ -79,17 +276,174 @@ def datahaku(url, query):
         print(f"Virhe haettaessa dataa:\n{e}")
         return None
     
-def line(df, x, y, hue, title):  
-    fig = px.line(df,
-                  x=x,
-                  y=y,
-                  color=hue,
-                  line_group=hue,
-                  hover_name=hue,
-                  markers=True,
-                  labels={x:x,y:y,hue:hue},
-                  title=title
-                  )
+# Piirrettyjen kaavioiden sormenjäljet tallennetaan tähän tiedostoon (tiedostonimi -> sormenjälki)
+KAAVIOLUETTELO = "kaaviot.json"
+
+# Tämän ajon aikana tallennetut tiedostot. Jos kaksi kaaviota tallennetaan samalle nimelle, jälkimmäinen
+# korvaa edellisen sekä tiedoston että sormenjäljen, jolloin kumpaakaan ei voi käyttää välimuistista.
+TALLENNETUT = set()
+
+# Funktio palauttaa kaaviofunktion käännetyn koodin, vakiot sekä kutsuttujen ja paikallisten nimien listat
+# (myös sisäfunktioiden) merkkijonona. Lähdekoodia ei käytetä, koska se ei ole saatavilla, kun koodia ajetaan
+# konsolissa solu kerrallaan.
+def koodin_tunniste(koodi):
+    osat = [koodi.co_code.hex(), repr(koodi.co_names), repr(koodi.co_varnames)]
+    for vakio in koodi.co_consts:
+        osat.append(koodin_tunniste(vakio) if inspect.iscode(vakio) else repr(vakio))
+    return "|".join(osat)
+
+# Funktio laskee kaavion sormenjäljen kaaviossa käytetyistä sarakkeista, kaavion parametreista, kaaviofunktioiden
+# koodista sekä Pythonin, pandasin, numpyn ja plotlyn versioista. Jos mikään näistä muuttuu, muuttuu myös sormenjälki.
+# kaaviot = kaaviofunktio ja ne apufunktiot, joita se kutsuu (esim. line, harvenna ja lttb).
+def sormenjalki(df, sarakkeet, kaaviot, parametrit):
+    sarakkeet = [s for s in dict.fromkeys(sarakkeet) if s is not None]
+    data = df[sarakkeet]
+
+    tunniste = hashlib.sha256()
+    tunniste.update(json.dumps([sarakkeet,
+                                [str(t) for t in data.dtypes],
+                                [koodin_tunniste(kaavio.__code__) for kaavio in kaaviot],
+                                parametrit,
+                                sys.version,
+                                pd.__version__,
+                                np.__version__,
+                                plotly.__version__], default=str).encode("utf-8"))
+    tunniste.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+
+    return tunniste.hexdigest()
+
+# Funktio tarkistaa, onko tiedosto jo piirretty samalla sormenjäljellä. Jos on, valmis tiedosto avataan selaimeen
+# eikä kaaviota tarvitse muodostaa ja tallentaa uudelleen.
+def valimuistissa(tiedosto, tunniste):
+    if not os.path.exists(tiedosto) or not os.path.exists(KAAVIOLUETTELO):
+        return False
+
+    with open(KAAVIOLUETTELO, encoding="utf-8") as f:
+        luettelo = json.load(f)
+
+    if luettelo.get(tiedosto) != tunniste:
+        return False
+
+    print(f"{tiedosto} on ajan tasalla, käytetään tallennettua kaaviota")
+    webbrowser.open("file://" + os.path.abspath(tiedosto))
+    return True
+
+# Funktio näyttää kaavion selaimessa, tallentaa sen HTML-tiedostoksi ja kirjaa sormenjäljen kaavioluetteloon.
+def tallenna(fig, tiedosto, tunniste):
+    if tiedosto in TALLENNETUT:
+        print(f"Varoitus: {tiedosto} on jo tallennettu tässä ajossa toisesta kaaviosta, käytä eri otsikkoa")
+    TALLENNETUT.add(tiedosto)
+
+    fig.show(renderer="browser")
+    fig.write_html(tiedosto)
+
+    luettelo = {}
+    if os.path.exists(KAAVIOLUETTELO):
+        with open(KAAVIOLUETTELO, encoding="utf-8") as f:
+            luettelo = json.load(f)
+
+    luettelo[tiedosto] = tunniste
+
+    with open(KAAVIOLUETTELO, "w", encoding="utf-8") as f:
+        json.dump(luettelo, f, ensure_ascii=False, indent=2)
+
+# Funktio valitsee Largest-Triangle-Three-Buckets (LTTB) -menetelmällä n pistettä, jotka säilyttävät sarjan muodon.
+# Ensimmäinen ja viimeinen piste pidetään, väliin jäävät pisteet jaetaan n-2 lokeroon ja jokaisesta lokerosta valitaan
+# piste, joka muodostaa suurimman kolmion edellisen valitun pisteen ja seuraavan lokeron keskiarvon kanssa.
+# x ja y ovat x:n mukaan järjestettyjä numpy-taulukoita. Palauttaa valittujen pisteiden indeksit.
+def lttb(x, y, n):
+    pituus = len(x)
+    if n < 3 or n >= pituus:
+        return np.arange(pituus)
+
+    rajat = np.linspace(1, pituus - 1, n - 1).astype(int)
+    valitut = np.empty(n, dtype=int)
+    valitut[0] = 0
+    valitut[-1] = pituus - 1
+    a = 0
+
+    for i in range(n - 2):
+        alku, loppu = rajat[i], rajat[i + 1]
+        seuraava_loppu = rajat[i + 2] if i + 2 < len(rajat) else pituus
+        ka_x = x[loppu:seuraava_loppu].mean()
+        ka_y = y[loppu:seuraava_loppu].mean()
+
+        ala = np.abs((x[a] - ka_x) * (y[alku:loppu] - y[a]) - (x[a] - x[alku:loppu]) * (ka_y - y[a]))
+        a = alku + np.argmax(ala)
+        valitut[i + 1] = a
+
+    return valitut
+
+# Funktio harventaa jokaisen sarjan (hue) enintään n pisteeseen LTTB-menetelmällä.
+# Aikaleimat ja numeeriset x-arvot käytetään sellaisenaan, muille x-arvoille käytetään järjestysnumeroa.
+def harvenna(df, x, y, hue, n):
+    df = df.dropna(subset=[x, y])
+    sarjat = df.groupby(hue, sort=False, dropna=False) if hue else [(None, df)]
+    osat = []
+
+    for _, sarja in sarjat:
+        sarja = sarja.sort_values(x)
+
+        if pd.api.types.is_datetime64_any_dtype(sarja[x]):
+            xs = sarja[x].astype("int64").to_numpy(dtype=float)
+        elif pd.api.types.is_numeric_dtype(sarja[x]):
+            xs = sarja[x].to_numpy(dtype=float)
+        else:
+            xs = np.arange(len(sarja), dtype=float)
+
+        osat.append(sarja.iloc[lttb(xs, sarja[y].to_numpy(dtype=float), n)])
+
+    return pd.concat(osat)
+
+# Viivakaavio. Kun piirrettäviä pisteitä on yli webgl_raja, käytetään WebGL-piirtoa ilman pistemerkkejä,
+# muuten SVG-piirtoa pistemerkein. Raja arvioidaan erikseen harvennetulle ja täydelle datalle.
+# harvennus = pisteiden enimmäismäärä sarjaa kohden: kaavio avautuu harvennettuna ja täysi data on mukana piilotettuna,
+# josta sen saa näkyviin "Kaikki pisteet" -painikkeella tarkempaa zoomausta varten.
+def line(df, x, y, hue, title, harvennus=None, webgl_raja=5000):
+    tiedosto = f"{title}.html"
+    tunniste = sormenjalki(df, [x, y, hue], [line, harvenna, lttb], [x, y, hue, title, harvennus, webgl_raja])
+    if valimuistissa(tiedosto, tunniste):
+        return
+
+    def piirra(data):
+        webgl = len(data) > webgl_raja
+        return px.line(data,
+                       x=x,
+                       y=y,
+                       color=hue,
+                       line_group=hue,
+                       hover_name=hue,
+                       markers=not webgl,
+                       render_mode="webgl" if webgl else "svg",
+                       labels={x:x,y:y,hue:hue},
+                       title=title
+                       )
+
+    harvennettu = harvenna(df, x, y, hue, harvennus) if harvennus else df
+    fig = piirra(harvennettu)
+
+    if len(harvennettu) < len(df):
+        kaikki = piirra(df)
+        for trace in kaikki.data:
+            trace.visible = False
+            fig.add_trace(trace)
+
+        n_harvennettu = len(fig.data) - len(kaikki.data)
+        n_kaikki = len(kaikki.data)
+        fig.update_layout(
+            updatemenus=[dict(
+                type="buttons",
+                direction="right",
+                x=1,
+                y=1.12,
+                buttons=[
+                    dict(label="Harvennettu", method="update",
+                         args=[{"visible": [True] * n_harvennettu + [False] * n_kaikki}]),
+                    dict(label="Kaikki pisteet", method="update",
+                         args=[{"visible": [False] * n_harvennettu + [True] * n_kaikki}])
+                    ]
+                )]
+            )
 
     fig.update_layout(
         height=600,
@@ -99,20 +453,28 @@ def line(df, x, y, hue, title):
         template="plotly_white"
         )
     
-    fig.show(renderer="browser")
-    fig.write_html(f"{title}.html")
+    tallenna(fig, tiedosto, tunniste)
 
 def pie(df, values, names, title):
+    tiedosto = f"{title}.html"
+    tunniste = sormenjalki(df, [values, names], [pie], [values, names, title])
+    if valimuistissa(tiedosto, tunniste):
+        return
+
     fig = px.pie(df,
                  values=values,
                  names=names,
                  title=title
                  )
     fig.update_traces(textposition="inside", textinfo="percent+label")
-    fig.show(renderer="browser")
-    fig.write_html(f"{title}.html")
+    tallenna(fig, tiedosto, tunniste)
     
 def bar(df, x, y, color, title, animation_frame):
+    tiedosto = f"{title}.html"
+    tunniste = sormenjalki(df, [x, y, color, animation_frame], [bar], [x, y, color, title, animation_frame])
+    if valimuistissa(tiedosto, tunniste):
+        return
+
     if pd.api.types.is_numeric_dtype(df[x]):
         text_value = x
     else:
@@ -135,14 +497,39 @@ def bar(df, x, y, color, title, animation_frame):
         template="plotly_white"
         )
     
-    fig.show(renderer="browser")
-    fig.write_html(f"{title}.html")    
+    tallenna(fig, tiedosto, tunniste)
+
+# Karttakaavio (choropleth), jossa alueet yhdistetään geojson-tiedoston ominaisuuteen featureidkey
+def kartta(df, geojson, locations, featureidkey, color, title, animation_frame, tiedosto):
+    geojson_tunniste = hashlib.sha256(json.dumps(geojson, sort_keys=True).encode("utf-8")).hexdigest()
+    tunniste = sormenjalki(df, [locations, color, animation_frame], [kartta],
+                           [geojson_tunniste, locations, featureidkey, color, title, animation_frame])
+    if valimuistissa(tiedosto, tunniste):
+        return
+
+    fig = px.choropleth(df,
+                        geojson=geojson,
+                        locations=locations,
+                        featureidkey=featureidkey,
+                        color=color,
+                        color_continuous_scale="Viridis",
+                        projection="mercator",
+                        title=title,
+                        animation_frame=animation_frame
+                        )
+    fig.update_geos(fitbounds="locations", visible=True)
+    tallenna(fig, tiedosto, tunniste)
+
+# Kun pisteitä on yli merkki_raja, pistemerkit jätetään pois. harvennus toimii kuten line-funktiossa,
+# mutta staattisessa kuvassa täyttä dataa ei ole mukana.
+def lineplt(df, xakseli, yakseli, hue, title, harvennus=None, merkki_raja=5000):
 
-def lineplt(df, xakseli, yakseli, hue, title):
+    if harvennus:
+        df = harvenna(df, xakseli, yakseli, hue, harvennus)
 
     plt.figure(figsize=(16,8))
 
-    sns.lineplot(data=df, x=xakseli, y=yakseli, hue=hue, marker = "o")
+    sns.lineplot(data=df, x=xakseli, y=yakseli, hue=hue, marker = "o" if len(df) <= merkki_raja else None)
     plt.title(title)
     plt.xlabel(xakseli)
     plt.ylabel(yakseli)
@@ -176,7 +563,138 @@ def heatmap(df):
     sns.heatmap(data=r2_matrix, annot=True, cmap="YlGnBu", vmin=0, vmax=1)
     plt.title("Selitysasteet (R²)")
     plt.show()
-    
+
+# Funktio hakee taulukon muuttujan arvojen koodit ja nimet PxWeb-rajapinnan metatiedoista (GET-pyyntö samaan osoitteeseen)
+def muuttujan_arvot(url, koodi):
+
+    try:
+        response = requests.get(url)
+        response.raise_for_status()
+
+        muuttuja = next(m for m in response.json()["variables"] if m["code"] == koodi)
+
+        return dict(zip(muuttuja["values"], muuttuja["valueTexts"]))
+
+    except requests.exceptions.RequestException as e:
+        print(f"Virhe haettaessa metatietoja:\n{e}")
+        return None
+
+# Funktio hakee kuntien ja maakuntien vastaavuudet Tilastokeskuksen luokituspalvelusta.
+# Palauttaa sanakirjan, jossa avaimena on PxWebin kuntakoodi (esim. "KU020") ja arvona maakunnan nimi.
+def kunnat_maakunnittain(vuosi):
+
+    url = ("https://data.stat.fi/api/classifications/v2/correspondenceTables/"
+           f"kunta_1_{vuosi}0101%23maakunta_1_{vuosi}0101/maps")
+    params = {"content": "data", "meta": "max", "lang": "fi"}
+
+    try:
+        response = requests.get(url, params=params)
+        response.raise_for_status()
+
+        return {"KU" + m["sourceItem"]["code"]: m["targetItem"]["classificationItemNames"][0]["name"]
+                for m in response.json()}
+
+    except requests.exceptions.RequestException as e:
+        print(f"Virhe haettaessa luokitusta:\n{e}")
+        return None
+
+# Funktio tiivistää yksivuotisikäryhmittäisen väestödatan alue- ja vuosikohtaisiksi summiksi
+# (koko väestö ja 65 vuotta täyttäneet). alueet-sanakirja muuntaa kuntakoodit joko kuntien tai maakuntien nimiksi.
+# Sama funktio käy sekä koko taulukolle että yksittäiselle palalle, koska summat voidaan laskea yhteen paloittain.
+# Jos jokin kuntakoodi puuttuu alueet-sanakirjasta, nostetaan virhe, jotta kunnan väestö ei putoa summista huomaamatta.
+def vaesto_ikaryhmittain(df, alueet):
+    df = df[df["Ikä"] != "SSS"]
+    ika = df["Ikä"].str.extract(r"^(\d+)", expand=False).astype(int)
+
+    alue = df["Alue"].map(alueet)
+    puuttuvat = df.loc[alue.isna(), "Alue"].unique()
+    if len(puuttuvat) > 0:
+        raise ValueError(f"Aluejaosta puuttuvat kunnat: {', '.join(puuttuvat)}")
+
+    df = df.assign(**{"Alue": alue,
+                      "Vuosi": df["Vuosi"].astype(int),
+                      "Yhteensä": df["value"],
+                      "65 -": df["value"].where(ika >= 65, 0)})
+
+    return df.groupby(["Alue", "Vuosi"])[["Yhteensä", "65 -"]].sum()
+
+# Funktio hakee suuren taulukon paloittain: annetun muuttujan (esim. "Alue") arvot jaetaan palan_koko-kokoisiin osiin
+# ja jokainen pala haetaan datahaku-funktiolla. Pala tiivistetään heti tiivista-funktiolla ryhmittäisiksi summiksi ja
+# lisätään kertyneisiin summiin, joten muistissa on kerrallaan vain yksi pala ja tiivistetty tulos.
+# API sallii 30 kyselyä 10 sekunnissa, joten palojen välillä pidetään tauko (sekunteina). Jos palan haku epäonnistuu
+# (esim. 429 - liikaa kyselyjä), sitä yritetään uudelleen yhteensä yritykset kertaa kasvavin odotusajoin (10, 20, 40 s).
+def datahaku_paloittain(url, query, koodi, palan_koko, tiivista, muoto=None, tauko=0.5, yritykset=4):
+
+    kysely = copy.deepcopy(query)
+    valinta = next(q["selection"] for q in kysely["query"] if q["code"] == koodi)
+    arvot = valinta["values"]
+    tulos = None
+
+    for alku in range(0, len(arvot), palan_koko):
+        valinta["values"] = arvot[alku:alku + palan_koko]
+
+        if alku > 0:
+            time.sleep(tauko)
+
+        for yritys in range(yritykset):
+            pala = datahaku(url, kysely, naming="id", muoto=muoto)
+            if pala is not None or yritys == yritykset - 1:
+                break
+            odotus = 10 * 2 ** yritys
+            print(f"Palan haku epäonnistui, yritetään uudelleen {odotus} sekunnin kuluttua")
+            time.sleep(odotus)
+
+        if pala is None:
+            print(f"Palan haku epäonnistui {yritykset} kertaa, keskeytetään paloittainen haku")
+            return None
+
+        pala = tiivista(pala)
+
+        if tulos is None:
+            tulos = pala
+        else:
+            tulos = pd.concat([tulos, pala]).groupby(level=pala.index.names).sum()
+
+        print(f"Käsitelty {min(alku + palan_koko, len(arvot))}/{len(arvot)}")
+
+    return tulos
+
+# Funktio vertaa paloittain laskettuja maakuntasummia valmiiksi maakunnittain haettuun väestöön (vaesto, query5).
+# Yksivuotisikäryhmistä lasketut summat on oltava samat kuin Tilastokeskuksen maakuntasummat, muuten nostetaan virhe.
+# Vertailu tehdään alueille, joiden nimi löytyy molemmista; muut alueet tulostetaan.
+def vertaa_maakuntasummiin(summat, vaesto):
+    vertailu = vaesto.assign(Alue=vaesto["Alue"].str.strip())
+    vertailu = vertailu.pivot_table(index=["Alue", "Vuosi"], columns="Ikä", values="value", aggfunc="sum")
+    vertailu = vertailu[["Yhteensä", "65 -"]]
+
+    yhteiset = summat.index.intersection(vertailu.index)
+    if len(yhteiset) == 0:
+        raise ValueError("Paloittain lasketuilla summilla ja maakuntien väestöllä ei ole yhteisiä alueita")
+
+    erot = summat.index.symmetric_difference(vertailu.index).get_level_values("Alue").unique()
+    if len(erot) > 0:
+        print(f"Alueet, joita ei voitu verrata: {', '.join(erot)}")
+
+    poikkeavat = (summat.loc[yhteiset] != vertailu.loc[yhteiset]).any(axis=1)
+    if poikkeavat.any():
+        raise ValueError(f"Paloittain lasketut summat poikkeavat maakuntien väestöstä: {list(poikkeavat[poikkeavat].index)}")
+
+    print("Paloittain lasketut summat vastaavat maakuntien väestöä")
+
+# Funktio laskee alueittaisista väestösummista 65 vuotta täyttäneiden osuuden ja, jos kotihoidon asiakastiedot annetaan,
+# kotihoidon asiakkaat tuhatta asukasta kohden. Asiakastiedot ovat maakunnittain, joten ne yhdistetään vain maakuntatasolla.
+def aluetunnusluvut(summat, kh=None):
+    df = summat.reset_index()
+    df["65-vuotta täyttäneiden osuus"] = (df["65 -"] / df["Yhteensä"] * 100).round(1)
+
+    if kh is not None:
+        kh = kh.rename(columns={"Maakunta": "Alue", "Arvo": "Kotihoidon asiakkaat"})
+        kh["Alue"] = kh["Alue"].str.strip()
+        df = pd.merge(df, kh, on=["Alue", "Vuosi"], how="inner")
+        df["Kotihoidon asiakkaat / 1000 asukasta"] = (df["Kotihoidon asiakkaat"] / df["Yhteensä"] * 1000).round(2)
+
+    return df
+
 # Haetaan tietolähteet tilastokeskuksen PxWeb-rajapinnasta käyttämällä "datahaku"-funktiota
 url = "https://pxdata.stat.fi:443/PxWeb/api/v1/fi/StatFin/eot/statfin_eot_pxt_11ze.px"
 query = {
@@ -559,7 +1077,7 @@ line(vaestosum,"Vuosi", "value", "Alue", "Väestönkehitys maakunnittain")
 bar(bktoecd_melted, "% bruttokansantuotteesta", "Maa", "Maa", "Terveydenhuollon käyttömenojen osuus bruttokansantuotteesta OECD-maissa", "Vuosi") 
 
 # Piirretään interaktiivinen ja animoitu palkkikaavio väestön kokonaiskehityksestä 
-bar(vaestosum, "value", "Alue", "Alue", "Väestönkehitys maakunnittain", "Vuosi")
+bar(vaestosum, "value", "Alue", "Alue", "Väestönkehitys maakunnittain ja vuosittain", "Vuosi")
 
 # Piirretään interaktiivinen ja animoitu palkkikaavio yli 65-vuotiaden väestökehityksestä maakunnittain
 bar(vanhat, "value", "Alue", "Alue", "Yli 65-vuotiaiden väestönkehitys maakunnittain", "Vuosi")
@@ -590,19 +1108,8 @@ with open("maakunnat.geojson", encoding="utf-8") as f:
     geojson = json.load(f)
 
 # Piirretään kartta ja käytetään maakunnan nimeä tunnisteena koordinaateille.   
-    fig = px.choropleth(ikaantyneet_MK,
-                        geojson=geojson,
-                        locations="Alue",
-                        featureidkey="properties.Maakunta",
-                        color="value",
-                        color_continuous_scale="Viridis",
-                        projection="mercator",
-                        title="Yli 65-vuotiaiden osuus väestöstä maakunnittain",
-                        animation_frame="Vuosi"
-                        )
-    fig.update_geos(fitbounds="locations", visible=True)
-    fig.show(renderer="browser")
-    fig.write_html("Yli65Map.html")
+kartta(ikaantyneet_MK, geojson, "Alue", "properties.Maakunta", "value",
+       "Yli 65-vuotiaiden osuus väestöstä maakunnittain", "Vuosi", "Yli65Map.html")
 
 # Piirretään palkkikaavio, jossa vertaillaan yksinäisyyden tunnetta väestössä vuosina 2018 ja 2022.
 bar(yksinaisyys, "Ikä", "Henkilöiden osuus (%)", "Yksinäinen", "Yksinäisyyden tunne väestössä ikäryhmittäin vuosina 2018 ja 2022", "Vuosi")
@@ -640,6 +1147,74 @@ bar(tyytyvaisyys, "value", "Itse koettu terveydentila", "Ikä", "Koetun tyytyvä
 # Piirretään pylväskaavio kotihoidon asiakasmäärien kehityksestä maakunnittain
 bar(kh_asiakkaat, "Arvo", "Maakunta", "Maakunta", "Kotihoidon asiakasmäärien kehitys maakunnittain vuosina 2014-2023", "Vuosi")
 
+# Tarkastellaan väestöä ja kotihoidon asiakkaita kunnittain tai maakunnittain yksivuotisikäryhmistä kaikilta vuosilta.
+# Kuntien yksivuotisikäryhmät ylittävät API:n 100 000 solun rajan, joten data haetaan paloittain (palan_koko kuntaa kerrallaan)
+# ja jokainen pala tiivistetään heti summiksi. Tulos on sama kuin jos koko taulukko tiivistettäisiin kerralla.
+# aluetaso = "kunta" laskee tunnusluvut kunnittain, "maakunta" maakunnittain. Kotihoidon asiakastiedot ovat vain maakunnittain.
+aluetaso = "maakunta"
+palan_koko = 20
+
+url7 = "https://pxdata.stat.fi:443/PxWeb/api/v1/fi/StatFin/vaerak/statfin_vaerak_pxt_11re.px"
+query7 = {
+  "query": [
+    {
+      "code": "Alue",
+      "selection": {
+        "filter": "item",
+        "values": []
+      }
+    },
+    {
+      "code": "Ikä",
+      "selection": {
+        "filter": "all",
+        "values": [
+          "*"
+        ]
+      }
+    },
+    {
+      "code": "Sukupuoli",
+      "selection": {
+        "filter": "item",
+        "values": [
+          "SSS"
+        ]
+      }
+    }
+  ],
+  "response": {
+    "format": "json-stat2"
+  }
+}
+
+kunnat = muuttujan_arvot(url7, "Alue")
+if kunnat is not None:
+    kunnat = {koodi: nimi for koodi, nimi in kunnat.items() if koodi.startswith("KU")}
+    query7["query"][0]["selection"]["values"] = list(kunnat)
+
+if aluetaso == "maakunta":
+    alueet = kunnat_maakunnittain(2025)
+else:
+    alueet = kunnat
+
+if kunnat is None or alueet is None:
+    print("Kuntien tai maakuntajaon tietoja ei saatu, ohitetaan alueittainen tarkastelu")
+    vaesto_alueittain = None
+else:
+    vaesto_alueittain = datahaku_paloittain(url7, query7, "Alue", palan_koko, lambda pala: vaesto_ikaryhmittain(pala, alueet), muoto="auto")
+
+# Tarkistetaan maakuntatasolla, että paloittain lasketut summat ovat samat kuin valmiit maakuntasummat (vaesto)
+if vaesto_alueittain is not None and aluetaso == "maakunta":
+    vertaa_maakuntasummiin(vaesto_alueittain, vaesto)
+
+# Piirretään palkkikaaviot 65 vuotta täyttäneiden osuudesta ja kotihoidon asiakkaista suhteessa väestöön
+if vaesto_alueittain is not None:
+    vaesto_alueittain = aluetunnusluvut(vaesto_alueittain, kh_asiakkaat if aluetaso == "maakunta" else None)
+    bar(vaesto_alueittain, "65-vuotta täyttäneiden osuus", "Alue", "Alue", f"Yli 65-vuotiaiden osuus ({aluetaso}taso)", "Vuosi")
+if vaesto_alueittain is not None and aluetaso == "maakunta":
+    bar(vaesto_alueittain, "Kotihoidon asiakkaat / 1000 asukasta", "Alue", "Alue", "Kotihoidon asiakkaat tuhatta asukasta kohden maakunnittain", "Vuosi")
+
 kh_asiakkaat_summa = kh_asiakkaat.groupby("Vuosi")["Arvo"].sum().reset_index()
 kh_asiakkaat_summa = kh_asiakkaat_summa.rename(columns={"Arvo" : "Kotihoidon asiakasmäärät"})
 ikaantyneet_kokomaa_14_23 = ikaantyneet_kokomaa[ikaantyneet_kokomaa["Vuosi"].between(2014, 2023)].reset_index()